@@ -14,32 +14,42 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-""" Conditional text generation with the auto-regressive models of the library (GPT/GPT-2/CTRL/Transformer-XL/XLNet)
+""" Conditional text generation with a fine-tuned auto-regressive model of the library (GPT-2)
 """
 
 
 import argparse
+import collections
+import csv
 import logging
+import queue
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import numpy as np
 import torch
-import pandas as pd
+from torch.nn.utils.rnn import pad_sequence
+from packaging import version
+import transformers
 from transformers import (
-    CTRLLMHeadModel,
-    CTRLTokenizer,
-    GPT2Tokenizer,
-    OpenAIGPTLMHeadModel,
-    OpenAIGPTTokenizer,
-    TransfoXLLMHeadModel,
-    TransfoXLTokenizer,
-    XLMTokenizer,
-    XLMWithLMHeadModel,
-    XLNetLMHeadModel,
-    XLNetTokenizer,
-    GPT2LMHeadModel
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
 )
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
 # from Module.GPT2Model import GPT2LMHeadModel
 
+# stopping criteria may return one flag per row since transformers 4.39, older versions need a single bool
+_PER_ROW_STOPPING = version.parse(transformers.__version__) >= version.parse("4.39.0")
+
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s", datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO,
 )
@@ -47,29 +57,11 @@ logger = logging.getLogger(__name__)
 
 MAX_LENGTH = int(10000)  # Hardcoded max length to avoid infinite loop
 
-MODEL_CLASSES = {
-    "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
-    "distilgpt2": (GPT2LMHeadModel, GPT2Tokenizer),
-    "ctrl": (CTRLLMHeadModel, CTRLTokenizer),
-    "openai-gpt": (OpenAIGPTLMHeadModel, OpenAIGPTTokenizer),
-    "xlnet": (XLNetLMHeadModel, XLNetTokenizer),
-    "transfo-xl": (TransfoXLLMHeadModel, TransfoXLTokenizer),
-    "xlm": (XLMWithLMHeadModel, XLMTokenizer),
-}
-
-# Padding text to help Transformer-XL and XLNet with short prompts as proposed by Aman Rusia
-# in https://github.com/rusiaaman/XLNet-gen#methodology
-# and https://medium.com/@amanrusia/xlnet-speaks-comparison-to-gpt-2-ea1a4e9ba39e
-PADDING_TEXT = """ In 1991, the remains of Russian Tsar Nicholas II and his family
-(except for Alexei and Maria) are discovered.
-The voice of Nicholas's young son, Tsarevich Alexei Nikolaevich, narrates the
-remainder of the story. 1883 Western Siberia,
-a young Grigori Rasputin is asked by his father and a group of men to perform magic.
-Rasputin has a vision and denounces one of the men as a horse thief. Although his
-father initially slaps him for making such an accusation, Rasputin watches as the
-man is chased outside and beaten. Twenty years later, Rasputin sees a vision of
-the Virgin Mary, prompting him to become a priest. Rasputin quickly becomes famous,
-with people, even a bishop, begging for his blessing. <eod> </s> <eos>"""
+MAX_PROMPT_LENGTH = 100  # prompts are cut to this many tokens, suffix included
+
+CONTENT_BEGIN = "<c-begin>"
+_MARKER_RE = re.compile(r"<pad>|<c-begin>")
+_CLEANUP = str.maketrans({"\n": " "})
 
 
 def set_seed(args):
@@ -79,63 +71,6 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
-#
-# Functions to prepare models' input
-#
-
-
-def prepare_ctrl_input(args, _, tokenizer, prompt_text):
-    if args.temperature > 0.7:
-        logger.info("CTRL typically works better with lower temperatures (and lower top_k).")
-
-    encoded_prompt = tokenizer.encode(prompt_text, add_special_tokens=False)
-    if not any(encoded_prompt[0] == x for x in tokenizer.control_codes.values()):
-        logger.info("WARNING! You are not starting your generation from a control code so you won't get good results")
-    return prompt_text
-
-
-def prepare_xlm_input(args, model, tokenizer, prompt_text):
-    # kwargs = {"language": None, "mask_token_id": None}
-
-    # Set the language
-    use_lang_emb = hasattr(model.config, "use_lang_emb") and model.config.use_lang_emb
-    if hasattr(model.config, "lang2id") and use_lang_emb:
-        available_languages = model.config.lang2id.keys()
-        if args.xlm_language in available_languages:
-            language = args.xlm_language
-        else:
-            language = None
-            while language not in available_languages:
-                language = input("Using XLM. Select language in " + str(list(available_languages)) + " >>> ")
-        # kwargs["language"] = tokenizer.lang2id[language]
-
-    # TODO fix mask_token_id setup when configurations will be synchronized between models and tokenizers
-    # XLM masked-language modeling (MLM) models need masked token
-    # is_xlm_mlm = "mlm" in args.model_name_or_path
-    # if is_xlm_mlm:
-    #     kwargs["mask_token_id"] = tokenizer.mask_token_id
-
-    return prompt_text
-
-
-def prepare_xlnet_input(args, _, tokenizer, prompt_text):
-    prompt_text = (args.padding_text if args.padding_text else PADDING_TEXT) + prompt_text
-    return prompt_text, {}
-
-
-def prepare_transfoxl_input(args, _, tokenizer, prompt_text):
-    prompt_text = (args.padding_text if args.padding_text else PADDING_TEXT) + prompt_text
-    return prompt_text, {}
-
-
-PREPROCESSING_FUNCTIONS = {
-    "ctrl": prepare_ctrl_input,
-    "xlm": prepare_xlm_input,
-    "xlnet": prepare_xlnet_input,
-    "transfo-xl": prepare_transfoxl_input,
-}
-
-
 def adjust_length_to_model(length, max_sequence_length):
     if length < 0 and max_sequence_length > 0:
         length = max_sequence_length
@@ -146,21 +81,281 @@ def adjust_length_to_model(length, max_sequence_length):
     return length
 
 
+class FusedSamplingProcessor(LogitsProcessor):
+    """Repetition penalty, temperature, top-k and top-p applied in one pass over the logits.
+
+    With a top-k cap the nucleus is taken from the already sorted ``torch.topk`` values, so the
+    full vocabulary is only sorted when top-p is used on its own.
+    """
+
+    def __init__(self, temperature=1.0, top_k=0, top_p=1.0, repetition_penalty=1.0):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+
+    def __call__(self, input_ids, scores):
+        scores = scores.clone()
+        if self.repetition_penalty != 1.0:
+            score = scores.gather(1, input_ids)
+            score = torch.where(score < 0, score * self.repetition_penalty, score / self.repetition_penalty)
+            scores.scatter_(1, input_ids, score)
+        return self.warp(scores)
+
+    def penalise_seen(self, scores, seen):
+        # same penalty as __call__, for callers that track the previous tokens as a [batch, vocab] mask
+        if self.repetition_penalty == 1.0:
+            return scores
+        penalised = torch.where(scores < 0, scores * self.repetition_penalty, scores / self.repetition_penalty)
+        return torch.where(seen, penalised, scores)
+
+    def warp(self, scores):
+        if self.temperature != 1.0:
+            scores.div_(self.temperature)
+        if self.top_k > 0:
+            values, indices = torch.topk(scores, min(self.top_k, scores.shape[-1]))
+            if self.top_p < 1.0:
+                probs = values.softmax(dim=-1)
+                # keep tokens until the mass before them exceeds top_p, the most likely one always stays
+                values = values.masked_fill(probs.cumsum(dim=-1) - probs > self.top_p, -float("inf"))
+            return torch.full_like(scores, -float("inf")).scatter_(1, indices, values)
+        if self.top_p < 1.0:
+            sorted_scores, sorted_index = torch.sort(scores, descending=True)
+            probs = sorted_scores.softmax(dim=-1)
+            remove = probs.cumsum(dim=-1) - probs > self.top_p
+            scores.masked_fill_(remove.scatter(1, sorted_index, remove), -float("inf"))
+        return scores
+
+
+def build_sampling(args):
+    # A (near) zero temperature or k == 1 is plain argmax decoding, which skips the softmax and the sort
+    if args.temperature <= 1e-4 or args.k == 1:
+        return False, FusedSamplingProcessor(repetition_penalty=args.repetition_penalty)
+    # an opt-in top-k prefilter keeps nucleus sampling from sorting the whole vocabulary at every step
+    top_k = args.nucleus_top_k if args.k == 0 and args.p < 1.0 else args.k
+    return True, FusedSamplingProcessor(args.temperature, top_k, args.p, args.repetition_penalty)
+
+
+def sampling_kwargs(args):
+    do_sample, processor = build_sampling(args)
+    kwargs = {"do_sample": do_sample, "logits_processor": LogitsProcessorList([processor])}
+    if do_sample:
+        # switch off the warpers of generate, the fused processor already applied them
+        kwargs.update(temperature=1.0, top_k=0, top_p=1.0)
+    return kwargs
+
+
+class StopOnTokens(StoppingCriteria):
+    """Stop each row once it has emitted the (multi-token) stop sequence or already ended.
+
+    A row that ended on EOS is filled with ``end_ids`` by generate and never matches the stop
+    sequence, so a last token in ``end_ids`` counts as done as well.
+    """
+
+    def __init__(self, stop_ids, end_ids):
+        self.stop_ids = stop_ids
+        self.end_ids = end_ids
+        self.stop = None
+        self.end = None
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.stop is None:
+            # copied to the device once, not on every decoding step
+            self.stop = torch.tensor(self.stop_ids, dtype=input_ids.dtype, device=input_ids.device)
+            self.end = torch.tensor(self.end_ids, dtype=input_ids.dtype, device=input_ids.device)
+        hit = (input_ids[:, -len(self.stop_ids):] == self.stop).all(dim=1)
+        hit |= (input_ids[:, -1:] == self.end).any(dim=1)
+        self.done = hit if self.done is None else self.done | hit
+        if _PER_ROW_STOPPING:
+            # generate retires every finished row on its own
+            return self.done.clone()
+        return bool(self.done.all())
+
+
+def stopping_kwargs(stop_ids, eos_token_id, pad_id):
+    if not stop_ids:
+        return {}
+    if len(stop_ids) == 1:
+        # single-token stops are finished per row by generate itself
+        return {"eos_token_id": [stop_ids[0], eos_token_id]}
+    # a fresh criterion per call, it keeps track of the rows that already stopped
+    return {"stopping_criteria": StoppingCriteriaList([StopOnTokens(stop_ids, [eos_token_id, pad_id])])}
+
+
+def sample_next_tokens(scores, seen, processor, do_sample):
+    # scores: [slots, vocab] logits of the last position, seen: [slots, vocab] tokens already in each row
+    # warp() works in place, copy so that shared prefill logits stay untouched
+    scores = processor.warp(processor.penalise_seen(scores.to(torch.float32, copy=True), seen))
+    if not do_sample:
+        return scores.argmax(dim=-1)
+    return torch.multinomial(scores.softmax(dim=-1), num_samples=1).squeeze(1)
+
+
+def _legacy_cache(past):
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+def _model_cache(legacy):
+    return DynamicCache.from_legacy_cache(legacy) if DynamicCache is not None else legacy
+
+
+def refill_generate(model, prompts, order, args, eos_ids, stop_ids):
+    """Decode the prompts with ``args.batch_size`` slots, refilling a slot as soon as its row stops.
+
+    Rows never wait for the slowest member of a fixed batch: a finished row is handed back and the
+    next queued prompt is prefilled into its slot, with its key/value states left-padded into the
+    shared cache. Yields ``(index, token_ids)`` in the order the rows finish.
+    """
+    pending = collections.deque(order)
+    num_slots = min(args.batch_size, len(pending))
+    slots = [None] * num_slots  # per slot: [prompt index, prompt + generated token ids]
+    past = None  # per layer (key, value), [slots, heads, time, head_dim]
+    mask = None  # [slots, time]
+    seen = None  # [slots, vocab]
+    next_tokens = torch.zeros(num_slots, dtype=torch.long, device=args.device)
+    do_sample, processor = build_sampling(args)
+
+    def finished(tokens):
+        if tokens[-1] in eos_ids or len(tokens) >= args.length:
+            return True
+        return len(stop_ids) > 1 and tokens[-len(stop_ids):] == stop_ids
+
+    def release(slot):
+        # an empty slot only attends to its own new positions, so it never blocks trimming the cache
+        mask[slot] = 0
+        row, slots[slot] = slots[slot], None
+        return row
+
+    last_prefill = None  # (prompt index, key/value states, last logits) of the latest prefilled prompt
+
+    def prefill(slot, index):
+        nonlocal past, mask, seen, last_prefill
+        prompt = prompts[index]
+        # the samples of one prompt are queued back to back, so they share a single prefill
+        if last_prefill is None or last_prefill[0] != index:
+            out = model(input_ids=prompt.unsqueeze(0), use_cache=True)
+            last_prefill = (index, _legacy_cache(out.past_key_values), out.logits[:, -1])
+        _, new, logits = last_prefill
+        length = prompt.shape[0]
+        if past is None:
+            past = [tuple(x.new_zeros((num_slots,) + x.shape[1:]) for x in layer) for layer in new]
+            mask = torch.zeros(num_slots, length, dtype=torch.long, device=args.device)
+            seen = torch.zeros(num_slots, logits.shape[-1], dtype=torch.bool, device=args.device)
+        time = mask.shape[1]
+        if length > time:
+            # widen the whole cache on the left so the new prompt fits
+            past = [tuple(torch.nn.functional.pad(x, (0, 0, length - time, 0)) for x in layer) for layer in past]
+            mask = torch.nn.functional.pad(mask, (length - time, 0))
+            time = length
+        for layer, new_layer in zip(past, new):
+            for x, new_x in zip(layer, new_layer):
+                x[slot].zero_()
+                x[slot, :, time - length:] = new_x[0]
+        mask[slot] = 0
+        mask[slot, time - length:] = 1
+        seen[slot] = False
+        seen[slot, prompt] = True
+        return logits
+
+    while pending or any(slot is not None for slot in slots):
+        for slot in range(num_slots):
+            while slots[slot] is None and pending:
+                index = pending.popleft()
+                logits = prefill(slot, index)
+                token = sample_next_tokens(logits, seen[slot: slot + 1], processor, do_sample)[0]
+                next_tokens[slot] = token
+                seen[slot, token] = True
+                slots[slot] = [index, prompts[index].tolist() + [token.item()]]
+                if finished(slots[slot][1]):
+                    yield release(slot)
+        if all(slot is None for slot in slots):
+            break
+
+        # one decoding step for every slot, the output of empty slots is ignored
+        mask = torch.nn.functional.pad(mask, (0, 1), value=1)
+        position_ids = (mask.cumsum(dim=1)[:, -1:] - 1).clamp(min=0)
+        out = model(input_ids=next_tokens.unsqueeze(1), past_key_values=_model_cache(tuple(past)),
+                    attention_mask=mask, position_ids=position_ids, use_cache=True)
+        past = list(_legacy_cache(out.past_key_values))
+        next_tokens = sample_next_tokens(out.logits[:, -1], seen, processor, do_sample)
+        seen[torch.arange(num_slots, device=args.device), next_tokens] = True
+
+        for slot, token in enumerate(next_tokens.tolist()):
+            if slots[slot] is None:
+                continue
+            slots[slot][1].append(token)
+            if finished(slots[slot][1]):
+                yield release(slot)
+
+        # drop the leading columns no live row attends to any more
+        start = int(mask.any(dim=0).long().argmax())
+        if start > 0:
+            past = [tuple(x[:, :, start:] for x in layer) for layer in past]
+            mask = mask[:, start:]
+
+
+def bucket_by_length(lengths, batch_size):
+    # Sort the prompts by length so that each mini-batch wastes as little padding as possible
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i: i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def left_pad(sequences, pad_id):
+    # GPT-2 continues from the last position, so the prompts are padded on the left; the mask comes
+    # from the prompt lengths because the pad id may also be a real token (eos when there is no <pad>)
+    flipped = [seq.flip(0) for seq in sequences]
+    padded = pad_sequence(flipped, batch_first=True, padding_value=pad_id).flip(1)
+    lengths = torch.tensor([seq.shape[0] for seq in sequences], device=padded.device)
+    positions = torch.arange(padded.shape[1], device=padded.device)
+    attention_mask = (positions.unsqueeze(0) >= (padded.shape[1] - lengths).unsqueeze(1)).long()
+    return padded, attention_mask
+
+
+def clean_generation(text, stop_token=None, from_begin=False):
+    # Cut the decoded text to [<c-begin>, stop_token) and strip the markers in a single pass
+    start = max(text.find(CONTENT_BEGIN), 0) if from_begin else 0
+    end = text.find(stop_token, start) if stop_token else -1
+    text = text[start: end if end >= 0 else None]
+    return _MARKER_RE.sub("", text).translate(_CLEANUP)
+
+
+def ordered_writer(fout, rows, errors):
+    # Rows arrive in bucket order; hold them back until every earlier row of the prompt file is written
+    pending = {}
+    next_index = 0
+    try:
+        while True:
+            item = rows.get()
+            if item is None:
+                break
+            index, line = item
+            pending[index] = line
+            while next_index in pending:
+                fout.write(pending.pop(next_index))
+                next_index += 1
+        # an interrupted run still keeps every finished row, in file order
+        for index in sorted(pending):
+            fout.write(pending[index])
+    except BaseException as e:
+        # handed back to the producers, which would otherwise block on the full queue
+        errors.append(e)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--model_type",
         default=None,
         type=str,
-        required=True,
-        help="Model type selected in the list: " + ", ".join(MODEL_CLASSES.keys()),
+        help="Kept for compatibility with older launch scripts, the model type is read from the checkpoint config",
     )
     parser.add_argument(
         "--model_name_or_path",
         default=None,
         type=str,
         required=True,
-        help="Path to pre-trained model or shortcut name selected in the list: " + ", ".join(MODEL_CLASSES.keys()),
+        help="Path to a fine-tuned causal language model or the shortcut name of a pre-trained one",
     )
 
     parser.add_argument("--prompt", type=str, default="")
@@ -171,19 +366,34 @@ def main():
         "--temperature",
         type=float,
         default=1,
-        help="temperature of 1.0 has no effect, lower tend toward greedy sampling",
+        help="temperature of 1.0 has no effect, lower tend toward greedy sampling, 0 is greedy decoding",
     )
     parser.add_argument(
         "--repetition_penalty", type=float, default=1.0, help="primarily useful for CTRL model; in that case, use 1.2"
     )
-    parser.add_argument("--k", type=int, default=0)
-    parser.add_argument("--p", type=float, default=0.9)
+    parser.add_argument("--k", type=int, default=0, help="top-k filtering, 1 is greedy decoding")
+    parser.add_argument("--p", type=float, default=0.9, help="top-p (nucleus) filtering, 1.0 turns it off")
+    parser.add_argument(
+        "--nucleus_top_k",
+        type=int,
+        default=0,
+        help="With --k 0, only take the nucleus from the top N tokens; faster, but it can cut the nucleus "
+        "on flat distributions. 0 keeps pure nucleus sampling",
+    )
+    parser.add_argument("--num_return_sequences", type=int, default=1, help="Number of samples generated per prompt")
 
-    parser.add_argument("--padding_text", type=str, default="", help="Padding text for Transfo-XL and XLNet.")
-    parser.add_argument("--xlm_language", type=str, default="", help="Optional language when used with the XLM model.")
+    parser.add_argument("--batch_size", type=int, default=8, help="Number of prompts generated in one batch")
+    parser.add_argument(
+        "--refill",
+        action="store_true",
+        help="Refill a batch slot as soon as its row stops instead of waiting for the batch; each of the "
+        "--num_return_sequences samples takes its own slot, with its prompt states copied from one shared prefill",
+    )
 
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
     parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    parser.add_argument("--no_fp16", action="store_true", help="Keep the model in fp32 when running on CUDA")
+    parser.add_argument("--torch_compile", action="store_true", help="Compile the model forward with torch.compile (bucketed file generation only)")
     parser.add_argument("--no_file", action="store_true", help="Generate without file")
     parser.add_argument("--prompt_file",type=str, default="", help="Prompt text and the conditional label")
     parser.add_argument("--output_file", type=str, default="", help="Output directory")
@@ -192,22 +402,42 @@ def main():
     parser.add_argument("--fact_sep", action="store_true", help="whether the input data contain the fact information")
     parser.add_argument("--cond_gen", action="store_true", help="whether the input data contain the fact information")
     args = parser.parse_args()
+    if args.torch_compile and (args.refill or args.no_file):
+        # only the bucketed generate path runs with a static cache, elsewhere the growing dynamic
+        # cache would make reduce-overhead record a new CUDA graph at every key/value length
+        parser.error("--torch_compile only works with the bucketed file generation, not with --refill or --no_file")
+    if args.num_return_sequences > 1 and not build_sampling(args)[0]:
+        parser.error("--num_return_sequences > 1 needs sampling, greedy decoding (--temperature 0 or --k 1) "
+                     "would return the same sequence every time")
 
     args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
     args.n_gpu = torch.cuda.device_count()
+    # TF32 matmuls on Ampere and newer, no effect elsewhere
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
     set_seed(args)
 
     # Initialize the model and tokenizer
-    try:
-        args.model_type = args.model_type.lower()
-        model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
-    except KeyError:
-        raise KeyError("the model {} you specified is not supported. You are welcome to add it and open a PR :)")
-
-    tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
-    model = model_class.from_pretrained(args.model_name_or_path)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=True)
+    model = AutoModelForCausalLM.from_pretrained(args.model_name_or_path)
     model.to(args.device)
+    if args.device.type == "cuda" and not args.no_fp16:
+        model.half()
+    model.eval()
+    # reuse the key/value states of the prefix instead of re-encoding it at every decoding step
+    model.config.use_cache = True
+    # only the token ids are used, never let the layers materialise attentions or hidden states
+    model.config.output_attentions = False
+    model.config.output_hidden_states = False
+    if args.torch_compile:
+        # generate() calls forward directly, so compile the forward rather than wrapping the module;
+        # the graphs are only replayed with the static cache file_gen passes to generate
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+
+    # stock GPT-2 has no pad token, only the checkpoints of run_lm.py add <pad>
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    stop_ids = tokenizer.encode(args.stop_token, add_special_tokens=False) if args.stop_token else []
 
     args.length = adjust_length_to_model(args.length, max_sequence_length=model.config.max_position_embeddings)
     logger.info(args)
@@ -217,73 +447,163 @@ def main():
         # prompt_list = open(args.prompt_file.format("src"),'r').readlines()
         # ref_list = open(args.prompt_file.format("tgt"),'r').readlines()
         # ref_content = [" ".join(i.strip().split()[:400]) for i in ref_list]
-        data = pd.read_csv(args.prompt_file, sep="\t")
-        prompt_list = data['title'].values.tolist()
-        ref_list = data['content'].values.tolist()
-        ref_content = [" ".join(i.strip().split()[:400]) for i in ref_list]
+        # only two string columns are needed, so read them with the csv module instead of pandas
+        csv.field_size_limit(sys.maxsize)
+        prompt_list = []
+        ref_content = []
+        with open(args.prompt_file, 'r', newline='', encoding='utf-8') as fin:
+            for row in csv.DictReader(fin, delimiter="\t"):
+                prompt_list.append(row['title'])
+                # bounded split: the tail of long articles is left in one piece
+                ref_content.append(" ".join(row['content'].split(None, 400)[:400]))
 
         # fact_list = ["<f-begin>" + " ".join((" ".join(i[-2].split("|"))).split(",")) + "<f-end>" for i in prompt_list]
         fact_raw = prompt_list
 
     
-        encoded_prompt = [tokenizer.encode(prompt_text + " <c-begin> ".strip(), add_special_tokens=False,  return_tensors="pt")[:100] for prompt_text in
-                          prompt_list]
-
-
-
-        fout = open(args.output_file, 'w+')
+        # one call into the fast tokenizer for the whole file instead of one per prompt; the suffix is
+        # tokenized once and appended after truncation so that long titles keep their <c-begin>
+        suffix_ids = tokenizer.encode(CONTENT_BEGIN, add_special_tokens=False)
+        encoded = tokenizer(prompt_list, add_special_tokens=False, truncation=True, max_length=MAX_PROMPT_LENGTH - len(suffix_ids))
+        encoded_prompt = [torch.tensor(ids + suffix_ids, dtype=torch.long) for ids in encoded["input_ids"]]
+        # move every prompt to the device in a single transfer, buckets are then built from views of it
+        prompt_lengths = [len(e_p) for e_p in encoded_prompt]
+        device_prompt = []
+        # a prompt file with only the header row still gets an output file with the header
+        if encoded_prompt:
+            all_input_ids = torch.cat(encoded_prompt)
+            if args.device.type == "cuda":
+                all_input_ids = all_input_ids.pin_memory()
+            all_input_ids = all_input_ids.to(args.device, non_blocking=True)
+            device_prompt = torch.split(all_input_ids, prompt_lengths)
+
+
+
+        fout = open(args.output_file, 'w+', buffering=1 << 20)
         total = len(encoded_prompt)
         # iter = zip(encoded_prompt, prompt_labels_list)
         fout.write("prompt\tref_fact\tref\tgen\tstyle_label\n")
-        with tqdm(total=total) as pbar:
-
-            for i, e_p in enumerate(encoded_prompt):
-                e_p = e_p.to(args.device)
-                output_sequences = model.generate(
-                        input_ids=e_p,
-                        max_length=args.length,
-                        temperature=args.temperature,
-                        top_k=args.k,
-                        top_p=args.p,
-                        repetition_penalty=args.repetition_penalty,
-                        do_sample=True
-                    )
-
-
-
-                generated_sequence = output_sequences[0].tolist()
-                text = tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
-                text = text[text.find("<c-begin>"): text.find(args.stop_token) if args.stop_token else None]
-                text = text.replace("<pad>", "")
-                text = text.replace("<c-begin>", "")
-                text = text.replace("\n", " ")
-                prompt_text = tokenizer.decode(e_p.cpu()[0].tolist(), clean_up_tokenization_spaces=True)
-
-                fout.write("{}\t{}\t{}\t{}\t{}\n".format(prompt_text.strip(),fact_raw[i].strip(),ref_content[i].strip(),text.strip(), 1))
-                pbar.update(1)
-        fout.close()
+        # the writer thread keeps disk I/O off the generation loop
+        rows = queue.Queue(maxsize=64)
+        writer_errors = []
+        writer = threading.Thread(target=ordered_writer, args=(fout, rows, writer_errors), daemon=True)
+        writer.start()
+
+        def put_row(row):
+            while True:
+                if writer_errors:
+                    raise RuntimeError("writing {} failed".format(args.output_file)) from writer_errors[0]
+                try:
+                    rows.put(row, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        # decode a finished bucket on a worker thread while the next bucket is generated
+        decoder = ThreadPoolExecutor(max_workers=1)
+        num_returns = args.num_return_sequences
+        # a static cache gives every decoding step of a bucket the same shapes, so the captured graphs are replayed
+        cache_kwargs = {"cache_implementation": "static"} if args.torch_compile else {}
+        try:
+            with tqdm(total=total * num_returns) as pbar:
+
+                def emit(i, r, text):
+                    text = clean_generation(text, args.stop_token, from_begin=True)
+                    prompt_text = prompt_list[i]
+                    # the samples of a prompt are written next to each other
+                    put_row((i * num_returns + r, "{}\t{}\t{}\t{}\t{}\n".format(prompt_text.strip(),fact_raw[i].strip(),ref_content[i].strip(),text.strip(), 1)))
+
+                if args.refill:
+                    # each sample gets its own slot, queued next to the other samples of its prompt
+                    order = [i for i in sorted(range(total), key=lambda i: prompt_lengths[i]) for _ in range(num_returns)]
+                    eos_ids = [tokenizer.eos_token_id] + (stop_ids if len(stop_ids) == 1 else [])
+                    returned = collections.Counter()
+                    with torch.inference_mode():
+                        for i, generated_sequence in refill_generate(model, device_prompt, order, args, eos_ids, stop_ids):
+                            emit(i, returned[i], tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=False))
+                            returned[i] += 1
+                            pbar.update(1)
+                else:
+                    def emit_bucket(bucket, width, sequences):
+                        # drop the left padding of each row, then keep the <c-begin>/<pad> markers because
+                        # clean_generation needs them to cut the text
+                        # each row keeps its own budget of args.length tokens, prompt included, like --refill
+                        trimmed = []
+                        for row, seq in enumerate(sequences):
+                            length = prompt_lengths[bucket[row // num_returns]]
+                            trimmed.append(seq[width - length: width + max(args.length - length, 0)])
+                        sequences = trimmed
+                        texts = tokenizer.batch_decode(sequences, clean_up_tokenization_spaces=False)
+                        # generate keeps the samples of one prompt in consecutive rows
+                        for row, text in enumerate(texts):
+                            emit(bucket[row // num_returns], row % num_returns, text)
+                        pbar.update(len(bucket) * num_returns)
+
+                    decoded = None
+                    for bucket in bucket_by_length(prompt_lengths, args.batch_size):
+                        input_ids, attention_mask = left_pad([device_prompt[i] for i in bucket], pad_id)
+                        with torch.inference_mode():
+                            output_sequences = model.generate(
+                                input_ids=input_ids,
+                                attention_mask=attention_mask,
+                                # max_length would count the left padding, so the shortest prompt of the
+                                # bucket sets the step count and emit_bucket cuts the longer ones back
+                                max_new_tokens=max(args.length - min(prompt_lengths[i] for i in bucket), 1),
+                                pad_token_id=pad_id,
+                                num_return_sequences=num_returns,
+                                use_cache=True,
+                                output_scores=False,
+                                output_attentions=False,
+                                output_hidden_states=False,
+                                return_dict_in_generate=False,
+                                **cache_kwargs,
+                                **sampling_kwargs(args),
+                                **stopping_kwargs(stop_ids, tokenizer.eos_token_id, pad_id)
+                            )
+
+                        sequences = output_sequences.tolist()
+                        if decoded is not None:
+                            decoded.result()
+                        decoded = decoder.submit(emit_bucket, bucket, input_ids.shape[1], sequences)
+                    if decoded is not None:
+                        decoded.result()
+        finally:
+            # let the decoder hand over its last rows, then flush whatever the writer still holds
+            decoder.shutdown()
+            while writer.is_alive():
+                try:
+                    rows.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            writer.join()
+            fout.close()
+        if writer_errors:
+            raise RuntimeError("writing {} failed".format(args.output_file)) from writer_errors[0]
     def prompt_gen():
         while True:
                     text = input("Prompt Text>>")
-                    e_p = tokenizer.encode(text, add_special_tokens=False, return_tensors="pt")
-                    e_p = e_p.to(args.device)
-                    output_sequences = model.generate(
-                        input_ids=e_p,
-                        max_length=args.length,
-                        temperature=args.temperature,
-                        top_k=args.k,
-                        top_p=args.p,
-                        repetition_penalty=args.repetition_penalty,
-                        do_sample=True
+                    e_p = tokenizer.encode(
+                        text, add_special_tokens=False, truncation=True, max_length=MAX_PROMPT_LENGTH, return_tensors="pt"
                     )
-
-                    # Batch size == 1. to add more examples please use num_return_sequences > 1
-                    generated_sequence = output_sequences[0].tolist()
-                    text = tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
-                    text = text[: text.find(args.stop_token) if args.stop_token else None]
-                    text = text.replace("<pad>", "")
-                    text = text.replace("\n", " ")
-                    print(text)
+                    e_p = e_p.to(args.device)
+                    with torch.inference_mode():
+                        output_sequences = model.generate(
+                            input_ids=e_p,
+                            max_length=args.length,
+                            pad_token_id=pad_id,
+                            num_return_sequences=args.num_return_sequences,
+                            use_cache=True,
+                            output_scores=False,
+                            output_attentions=False,
+                            output_hidden_states=False,
+                            return_dict_in_generate=False,
+                            **sampling_kwargs(args),
+                            **stopping_kwargs(stop_ids, tokenizer.eos_token_id, pad_id)
+                        )
+
+                    for text in tokenizer.batch_decode(output_sequences, clean_up_tokenization_spaces=False):
+                        print(clean_generation(text, args.stop_token))
     if args.no_file:
         prompt_gen()
     else: